@@ -1,55 +1,434 @@
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI, File, UploadFile
-from transformers import AutoProcessor, AutoModelForCTC
-import librosa
+from pathlib import Path
+from transformers import AutoConfig, AutoProcessor, AutoModelForCTC, BitsAndBytesConfig
+from audio2corpus.preprocessor import decode_audio, split_audio
+import aiofiles
+import asyncio
+import numpy as np
 import os
+import soxr
 import torch
+import torchaudio
 
-app = FastAPI()
+MODEL_NAME = "mms-meta/mms-zeroshot-300m"
 
-#load model
-processor = AutoProcessor.from_pretrained("mms-meta/mms-zeroshot-300m")
-model = AutoModelForCTC.from_pretrained("mms-meta/mms-zeroshot-300m")
-app.state.model = model
+# "torch" runs the HuggingFace model directly, "onnx" serves an exported
+# graph through ONNX Runtime (TensorRT execution provider when available).
+# The exported graph (~1.2 GB) and the TensorRT engines are kept in a user
+# cache directory rather than the working directory
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+CACHE_DIR = os.environ.get("CACHE_DIR", str(Path.home() / ".cache" / "audio2corpus"))
+ONNX_PATH = os.environ.get("ONNX_PATH", os.path.join(CACHE_DIR, "mms.onnx"))
+TRT_CACHE_DIR = os.environ.get("TRT_CACHE_DIR", os.path.join(CACHE_DIR, "trt_cache"))
 
-@app.post("/transcribe/")
-async def transcribe(audio_file: UploadFile = File(...),
-                     vocab_file: UploadFile = File(...)
-                     ):
+# Uploads that have to touch the filesystem go to the system temp dir, unless
+# TEMP_DIR points elsewhere. TEMP_DIR=/dev/shm keeps them in RAM, but Docker
+# only gives containers 64 MB there unless started with a larger --shm-size
+TEMP_DIR = os.environ.get("TEMP_DIR")
 
-    # Save the uploaded audio file
-    audio_path = f"temp_{audio_file.filename}"
-    with open(audio_path, "wb") as f:
-        f.write(await audio_file.read())
+# Long audio is cut into MAX_DURATION second segments, transcribed
+# MAX_BATCH_SIZE segments per forward pass
+MAX_DURATION = int(os.environ.get("MAX_DURATION", 30))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 4))
+# How long the batcher waits for segments of concurrent requests to join a batch
+BATCH_WINDOW = float(os.environ.get("BATCH_WINDOW_MS", 10)) / 1000
+# Requests waiting on a full queue put their segments in turn, so a long upload
+# only gets MAX_QUEUED_SEGMENTS ahead of the requests that arrive after it
+MAX_QUEUED_SEGMENTS = int(os.environ.get("MAX_QUEUED_SEGMENTS", 2 * MAX_BATCH_SIZE))
+
+# With LOAD_IN_8BIT=1 the torch backend quantizes the linear layers to INT8
+# with bitsandbytes on GPU, the remaining layers stay in FP16
+LOAD_IN_8BIT = os.environ.get("LOAD_IN_8BIT", "0") == "1"
+
+
+def build_onnx_session(onnx_path=ONNX_PATH):
+    """
+    Exports the CTC model to ONNX (once) and opens an ONNX Runtime session on it.
+
+    The PyTorch model is only loaded when the graph has not been exported yet.
+
+    The TensorRT execution provider builds an FP16 engine for the shape profile
+    below and caches it in TRT_CACHE_DIR, so the build only happens on first start.
+    CUDA and CPU providers are used as fallbacks when TensorRT is unavailable.
+
+    Parameters:
+        onnx_path (str): Where the exported graph is stored
+
+    Returns:
+        onnxruntime.InferenceSession: Session returning the logits
+    """
+    import onnxruntime as ort
+
+    os.makedirs(TRT_CACHE_DIR, exist_ok=True)
+    if not os.path.exists(onnx_path):
+        os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+        model = AutoModelForCTC.from_pretrained(MODEL_NAME, low_cpu_mem_usage=True)
+        dummy_input_values = torch.zeros(1, 16000)
+        dummy_attention_mask = torch.ones(1, 16000, dtype=torch.long)
+        torch.onnx.export(model, (dummy_input_values, dummy_attention_mask), onnx_path,
+                          input_names=["input_values", "attention_mask"],
+                          output_names=["logits"],
+                          opset_version=17,
+                          dynamic_axes={"input_values": {0: "B", 1: "T"},
+                                        "attention_mask": {0: "B", 1: "T"},
+                                        "logits": {0: "B", 1: "T"}})
+
+    max_samples = MAX_DURATION * 16000
+
+    def shapes(batch_size, length):
+        return f"input_values:{batch_size}x{length},attention_mask:{batch_size}x{length}"
+
+    trt_options = {
+        "trt_fp16_enable": True,
+        "trt_engine_cache_enable": True,
+        "trt_engine_cache_path": TRT_CACHE_DIR,
+        # 400 samples is the receptive field of the convolutional feature encoder
+        "trt_profile_min_shapes": shapes(1, 400),
+        "trt_profile_opt_shapes": shapes(1, max_samples),
+        "trt_profile_max_shapes": shapes(MAX_BATCH_SIZE, max_samples),
+    }
+    providers = [("TensorrtExecutionProvider", trt_options),
+                 "CUDAExecutionProvider",
+                 "CPUExecutionProvider"]
+    return ort.InferenceSession(onnx_path, providers=providers)
+
+
+async def save_upload(upload, chunk_size=1 << 20):
+    """
+    Streams an uploaded file to a new temporary file one chunk at a time.
+
+    The file gets a unique name in TEMP_DIR, keeping the upload's extension,
+    and has to be removed by the caller.
+
+    Parameters:
+        upload (UploadFile): The uploaded file
+        chunk_size (int): Number of bytes read per chunk
+
+    Returns:
+        str: Path of the temporary file
+    """
+    suffix = Path(upload.filename or "").suffix
+    async with aiofiles.tempfile.NamedTemporaryFile("wb", dir=TEMP_DIR, suffix=suffix,
+                                                    delete=False) as f:
+        try:
+            while chunk := await upload.read(chunk_size):
+                await f.write(chunk)
+        except BaseException:
+            # Also on cancellation, when the client goes away mid-upload
+            os.remove(f.name)
+            raise
+    return f.name
+
+
+def load_model(state):
+    """
+    Loads the processor, the model config and the inference backend into the app state.
+
+    Weights are loaded directly in the serving dtype with low_cpu_mem_usage, so
+    the FP32 checkpoint is not materialized in full before being cast.
+
+    The torch backend normalizes the input values on its device in forward(),
+    so normalization is switched off in the feature extractor and recorded in
+    state.normalize instead.
+
+    Parameters:
+        state (starlette.datastructures.State): The app state to fill
+    """
+    processor = AutoProcessor.from_pretrained(MODEL_NAME)
+    state.processor = processor
+    state.config = AutoConfig.from_pretrained(MODEL_NAME)
+    state.device = "cuda" if torch.cuda.is_available() else "cpu"
+    state.dtype = torch.float16 if state.device == "cuda" else torch.float32
+
+    if INFERENCE_BACKEND == "onnx":
+        state.session = build_onnx_session()
+        state.normalize = False
+        return
+
+    state.normalize = processor.feature_extractor.do_normalize
+    processor.feature_extractor.do_normalize = False
+
+    if LOAD_IN_8BIT and state.device == "cuda":
+        model = AutoModelForCTC.from_pretrained(MODEL_NAME,
+                                                quantization_config=BitsAndBytesConfig(load_in_8bit=True),
+                                                dtype=state.dtype,
+                                                device_map=state.device)
+    else:
+        # Move the weights to the GPU once, FP16 there for Tensor Core kernels
+        model = AutoModelForCTC.from_pretrained(MODEL_NAME, low_cpu_mem_usage=True, dtype=state.dtype)
+        model = model.to(state.device)
+    state.model = model.eval()
+
+
+def frame_lengths(sample_lengths):
+    """
+    Computes the number of logit frames the model produces per input length.
+
+    Same arithmetic as the model's _get_feat_extract_output_lengths, computed from
+    the config so it also works for the ONNX backend.
+
+    Parameters:
+        sample_lengths (torch.Tensor): Unpadded lengths of the inputs in samples
+
+    Returns:
+        torch.Tensor: Number of valid logit frames per input
+    """
+    config = app.state.config
+    for kernel_size, stride in zip(config.conv_kernel, config.conv_stride):
+        sample_lengths = (sample_lengths - kernel_size) // stride + 1
+    if config.add_adapter:
+        for _ in range(config.num_adapter_layers):
+            sample_lengths = (sample_lengths - 1) // config.adapter_stride + 1
+    return sample_lengths
+
+
+def normalize(input_values, attention_mask):
+    """
+    Normalizes each waveform to zero mean and unit variance over its unpadded part.
+
+    Same result as the feature extractor's normalization, but computed on the
+    device the inputs live on, with padding left at zero.
+
+    Parameters:
+        input_values (torch.Tensor): Batch of float32 waveforms
+        attention_mask (torch.Tensor): Matching attention mask
+
+    Returns:
+        torch.Tensor: The normalized batch
+    """
+    mask = attention_mask.to(input_values.dtype)
+    lengths = mask.sum(-1, keepdim=True)
+    mean = (input_values * mask).sum(-1, keepdim=True) / lengths
+    centered = (input_values - mean) * mask
+    var = (centered * centered).sum(-1, keepdim=True) / lengths
+    return centered / torch.sqrt(var + 1e-7)
 
-    # Save the uploaded vocabulary file
-    vocab_path = f"temp_{vocab_file.filename}"
-    with open(vocab_path, "wb") as f:
-        f.write(await vocab_file.read())
 
-    # Load the audio
-    waveform, sample_rate = librosa.load(audio_path, sr=16000, mono=True)
+def forward(model, input_values, attention_mask):
+    """
+    Runs the model on float32 input values already on its device.
 
-    #preprocess the audio
-    inputs = processor(waveform, sampling_rate=16000, return_tensors="pt", padding=True)
+    Normalization statistics are computed in float32 before casting to the
+    model dtype, as FP16 sums over a 30 s segment would overflow.
 
-    model=app.state.model
+    Parameters:
+        model (AutoModelForCTC): The model
+        input_values (torch.Tensor): Batch of float32 waveforms
+        attention_mask (torch.Tensor): Matching attention mask
 
-    # Device Management
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.to(device)
-    inputs = inputs.to(device)
+    Returns:
+        torch.Tensor: The logits
+    """
+    if app.state.normalize:
+        input_values = normalize(input_values, attention_mask)
+    input_values = input_values.to(app.state.dtype)
+    return model(input_values, attention_mask=attention_mask).logits
 
-    # Perform transcription
-    with torch.no_grad():
-            logits = model(inputs.input_values).logits
 
-    # Decode the logits to transcription
-    predicted_ids = torch.argmax(logits, dim=-1)
-    transcription = processor.batch_decode(predicted_ids, skip_special_tokens=True)[0]
+def pad_on_host(segments):
+    """
+    Resamples segments to 16 kHz with soxr and pads them into a batch on the CPU.
+
+    Parameters:
+        segments (list): List of (mono waveform, sample rate) pairs
+
+    Returns:
+        tuple: (input values, attention mask) as CPU tensors
+    """
+    waveforms = []
+    for waveform, sample_rate in segments:
+        if sample_rate != 16000:
+            waveform = soxr.resample(waveform, sample_rate, 16000)
+        # Decoding and resampling keep float32, make sure nothing upstream promoted
+        # a segment to float64 (no copy when the dtype already matches)
+        waveforms.append(np.asarray(waveform, dtype=np.float32))
+
+    inputs = app.state.processor(waveforms, sampling_rate=16000, return_tensors="pt", padding=True)
+    attention_mask = inputs.get("attention_mask")
+    if attention_mask is None:
+        attention_mask = torch.ones_like(inputs.input_values, dtype=torch.long)
+    return inputs.input_values, attention_mask
+
+
+def pad_on_device(segments):
+    """
+    Resamples segments to 16 kHz and pads them into a batch on the model's device.
+
+    Only the decoded samples cross PCIe, copied from pinned memory; resampling
+    runs as torchaudio's conv1d on the GPU and the 16 kHz batch is built there.
+
+    Parameters:
+        segments (list): List of (mono waveform, sample rate) pairs
+
+    Returns:
+        tuple: (input values, attention mask) on the model's device
+    """
+    device = app.state.device
+    waveforms = []
+    for waveform, sample_rate in segments:
+        # Copies from page-locked memory run asynchronously, from pageable
+        # memory non_blocking has no effect
+        waveform = torch.from_numpy(waveform).pin_memory().to(device, non_blocking=True)
+        if sample_rate != 16000:
+            waveform = torchaudio.functional.resample(waveform, sample_rate, 16000)
+        waveforms.append(waveform)
+
+    input_values = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+    lengths = torch.tensor([len(waveform) for waveform in waveforms], device=device)
+    positions = torch.arange(input_values.shape[1], device=device)
+    attention_mask = (positions < lengths[:, None]).long()
+    return input_values, attention_mask
+
+
+def transcribe_batch(segments):
+    """
+    Transcribes a batch of waveforms with a single forward pass.
+
+    The torch backend on GPU resamples and pads on the device; otherwise the
+    segments are resampled and padded by the processor on the CPU.
+
+    Parameters:
+        segments (list): List of (mono waveform, sample rate) pairs
+
+    Returns:
+        list: One transcription per waveform
+    """
+    if INFERENCE_BACKEND != "onnx" and app.state.device == "cuda":
+        input_values, attention_mask = pad_on_device(segments)
+    else:
+        input_values, attention_mask = pad_on_host(segments)
+
+    if INFERENCE_BACKEND == "onnx":
+        outputs = app.state.session.run(["logits"], {
+            "input_values": input_values.numpy(),
+            "attention_mask": attention_mask.numpy(),
+        })
+        logits = torch.from_numpy(outputs[0])
+    else:
+        model=app.state.model
+        input_values = input_values.to(app.state.device, non_blocking=True)
+        attention_mask = attention_mask.to(app.state.device, non_blocking=True)
+
+        with torch.inference_mode():
+            logits = forward(model, input_values, attention_mask)
+
+    # Decode the logits to transcription, the argmax runs where the logits are
+    # so only the token ids are copied back to the CPU. Each row is cut to the
+    # frames of its own segment so the batch padding is not decoded
+    predicted_ids = logits.argmax(dim=-1).cpu()
+    lengths = frame_lengths(attention_mask.sum(-1).cpu()).tolist()
+    rows = [ids[:length].tolist() for ids, length in zip(predicted_ids, lengths)]
+    return app.state.processor.batch_decode(rows, skip_special_tokens=True)
+
+
+def fail_futures(items, exception):
+    """
+    Sets an exception on the futures of queued segments that are still pending.
+
+    Parameters:
+        items (list): List of (waveform, sample rate, future) triples
+        exception (Exception): The exception the waiting requests raise
+    """
+    for *_, future in items:
+        if not future.done():
+            future.set_exception(exception)
+
+
+async def batch_worker(queue):
+    """
+    Collects queued segments into batches and transcribes them.
+
+    Once a first segment arrives, more are collected for up to BATCH_WINDOW
+    seconds or until MAX_BATCH_SIZE are queued, so segments from concurrent
+    requests share one forward pass. The forward pass runs in a thread to keep
+    the event loop free for incoming uploads. Segments whose request already
+    failed or went away are dropped, and a cancelled worker fails the batch
+    it was running.
+
+    Parameters:
+        queue (asyncio.Queue): Queue of (waveform, sample rate, future) triples
+    """
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [item for item in batch if not item[-1].done()]
+            if not batch:
+                continue
+
+            segments = [(waveform, sample_rate) for waveform, sample_rate, _ in batch]
+            try:
+                transcriptions = await asyncio.to_thread(transcribe_batch, segments)
+            except Exception as e:
+                fail_futures(batch, e)
+            else:
+                for (*_, future), transcription in zip(batch, transcriptions):
+                    if not future.done():
+                        future.set_result(transcription)
+    except asyncio.CancelledError:
+        fail_futures(batch, RuntimeError("The batcher was stopped"))
+        raise
+
+
+@asynccontextmanager
+async def lifespan(app):
+    load_model(app.state)
+
+    queue = app.state.batch_queue = asyncio.Queue(maxsize=MAX_QUEUED_SEGMENTS)
+    batcher = asyncio.create_task(batch_worker(queue))
+    yield
+    batcher.cancel()
+    with suppress(asyncio.CancelledError):
+        await batcher
+
+    # Fail the segments still queued so their requests answer instead of hanging.
+    # Yielding lets requests blocked on the full queue put their next segment
+    while not queue.empty():
+        fail_futures([queue.get_nowait()], RuntimeError("The server is shutting down"))
+        await asyncio.sleep(0)
+
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/transcribe/")
+async def transcribe(audio_file: UploadFile = File(...),
+                     vocab_file: UploadFile = File(...)
+                     ):
+
+    # Save the uploaded vocabulary file
+    vocab_path = await save_upload(vocab_file)
+    futures = []
+    try:
+        # Decode the audio as mono at its own sample rate, in a worker thread so
+        # long files do not stall other uploads and the batcher. Resampling to
+        # 16 kHz is left to the batcher, which does it where the model runs
+        waveform, sample_rate = await asyncio.to_thread(decode_audio, audio_file.file)
 
-    # Clean up the temporary file
-    os.remove(audio_path)
-    os.remove(vocab_path)
+        # Cut long audio into segments and queue them for the batcher
+        loop = asyncio.get_running_loop()
+        for segment in split_audio(waveform, sample_rate, MAX_DURATION * 1000):
+            future = loop.create_future()
+            await app.state.batch_queue.put((segment, sample_rate, future))
+            futures.append(future)
+        transcription = " ".join(await asyncio.gather(*futures))
+    finally:
+        # Once a segment fails, the batcher drops the remaining ones
+        for future in futures:
+            future.cancel()
+        # Clean up the temporary file
+        os.remove(vocab_path)
 
     return {"transcription": transcription}
 
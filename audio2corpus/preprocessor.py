@@ -1,103 +1,111 @@
-from pydub import AudioSegment
-import os
 from pathlib import Path
-import librosa
+import soundfile
+import soxr
+import torchaudio
 
 """
 Audio preprocessing module for transcription API.
 Handles format conversion, sample rate adjustment, and audio splitting.
 """
 
-def split_audio(audio, segment_length=30000):
+def split_audio(waveform, sample_rate, segment_length=30000, min_length=25):
     """
-    Splits an audio segment into multiple smaller segments of equal length.
+    Splits a waveform into multiple smaller segments of equal length.
+
+    A tail shorter than min_length is dropped: the model's convolutional feature
+    encoder needs at least 400 samples at 16 kHz (25 ms) and fails on less.
 
     Parameters:
-        audio (AudioSegment): The audio to be split
+        waveform (numpy.ndarray): The mono waveform to be split
+        sample_rate (int): Sample rate of the waveform in Hz
         segment_length (int): Length of each segment in milliseconds
+        min_length (int): Minimum length of the last segment in milliseconds
 
     Returns:
-        list: List of paths to temporary WAV files containing the segments
+        list: List of waveforms (views into the input array)
     """
-    segments = []
-    audio_length = len(audio)
-    temp_paths = []
+    segment_samples = segment_length * sample_rate // 1000
+    min_samples = -(-min_length * sample_rate // 1000)
+    n_full = len(waveform) // segment_samples
+
+    # Full segments are the rows of a single reshaped view, the tail is kept
+    # unpadded so the processor pads it together with the rest of its batch
+    segments = list(waveform[:n_full * segment_samples].reshape(n_full, segment_samples))
+    if len(waveform) - n_full * segment_samples >= min_samples:
+        segments.append(waveform[n_full * segment_samples:])
 
-    for start in range(0, audio_length, segment_length):
-        end = min(start + segment_length, audio_length)
-        segment = audio[start:end]
+    return segments
+
+def decode_audio(source):
+    """
+    Decodes audio into a mono float32 waveform at its own sample rate.
+
+    Audio is decoded with libsndfile; formats it cannot decode (e.g. MP3, M4A)
+    fall back to torchaudio.
+
+    Parameters:
+        source (str or file-like): Path to the audio file, or a seekable binary file
 
-        # Save segment to temporary file
-        temp_path = f"temp_segment_{len(temp_paths):02d}.wav"
-        segment.export(temp_path, format='wav')
-        temp_paths.append(temp_path)
+    Returns:
+        tuple: (mono waveform, sample rate in Hz)
+    """
+    try:
+        waveform, sample_rate = soundfile.read(source, dtype="float32", always_2d=False)
+    except RuntimeError:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        waveform, sample_rate = torchaudio.load(source)
+        return waveform.mean(0).numpy(), sample_rate
+
+    if waveform.ndim > 1:
+        waveform = waveform.mean(axis=1)
+    return waveform, sample_rate
+
+def load_audio(input_path, target_sr=16000):
+    """
+    Loads an audio file as a mono float32 waveform at the target sample rate.
 
-    return temp_paths
+    Parameters:
+        input_path (str): Path to input audio file
+        target_sr (int): Target sample rate in Hz
+
+    Returns:
+        numpy.ndarray: The mono waveform
+    """
+    waveform, sample_rate = decode_audio(input_path)
+
+    # Convert sample rate if needed
+    if sample_rate != target_sr:
+        print(f"Converting to {target_sr} Hz...")
+        waveform = soxr.resample(waveform, sample_rate, target_sr)
+
+    return waveform
 
 def preprocess_audio(input_path, target_sr=16000, max_duration=30):
     """
     Preprocesses audio file for transcription.
 
     Parameters:
-        input_path (str): Path to input audio file (can be temporary)
+        input_path (str): Path to input audio file
         target_sr (int): Target sample rate in Hz
         max_duration (int): Maximum duration of each segment in seconds
 
     Returns:
-        tuple: (list of waveforms, list of temp files to clean up)
+        list: List of waveforms of at most max_duration seconds each
     """
     try:
         print(f"Processing file: {input_path}")
-        temp_files = []
-        waveforms = []
+        waveform = load_audio(input_path, target_sr)
 
-        # Load the audio file using pydub
-        audio = AudioSegment.from_file(input_path)
-
-        # Convert sample rate if needed
-        if audio.frame_rate != target_sr:
-            print(f"Converting to {target_sr} Hz...")
-            audio = audio.set_frame_rate(target_sr)
-
-        duration = len(audio) / 1000
+        duration = len(waveform) / target_sr
         print(f"Audio duration: {duration:.2f} seconds")
 
         if duration > max_duration:
             print(f"Audio longer than {max_duration} seconds, splitting into parts...")
-            segment_paths = split_audio(audio, max_duration * 1000)
-            temp_files.extend(segment_paths)
-
-            # Load each segment with librosa
-            for path in segment_paths:
-                waveform, _ = librosa.load(path, sr=target_sr, mono=True)
-                waveforms.append(waveform)
-        else:
-            # For short audio, process directly
-            temp_path = "temp_processed.wav"
-            audio.export(temp_path, format='wav')
-            temp_files.append(temp_path)
 
-            waveform, _ = librosa.load(temp_path, sr=target_sr, mono=True)
-            waveforms.append(waveform)
-
-        return waveforms, temp_files
+        # Short audio comes back as a single segment
+        return split_audio(waveform, target_sr, max_duration * 1000)
 
     except Exception as e:
         print(f"Error preprocessing audio: {e}")
-        # Clean up any temporary files that might have been created
-        for temp_file in temp_files:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
         raise
-
-def cleanup_temp_files(temp_files):
-    """
-    Removes temporary files created during preprocessing.
-
-    Parameters:
-        temp_files (list): List of temporary file paths to remove
-    """
-    for temp_file in temp_files:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-            print(f"Cleaned up temporary file: {temp_file}")
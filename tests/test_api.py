@@ -0,0 +1,241 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+import pytest
+import torch
+from transformers import (Wav2Vec2Config, Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor,
+                          Wav2Vec2ForCTC, Wav2Vec2Processor)
+
+import api.fast as fast
+
+
+def test_normalize_matches_feature_extractor():
+    rng = np.random.default_rng(0)
+    lengths = [1600, 1000, 400]
+    input_values = np.zeros((len(lengths), max(lengths)), dtype=np.float32)
+    attention_mask = np.zeros((len(lengths), max(lengths)), dtype=np.int64)
+    for row, length in enumerate(lengths):
+        input_values[row, :length] = rng.standard_normal(length) * 0.3 + 0.1
+        attention_mask[row, :length] = 1
+
+    expected = Wav2Vec2FeatureExtractor.zero_mean_unit_var_norm(
+        list(input_values), list(attention_mask), padding_value=0.0)
+    actual = fast.normalize(torch.from_numpy(input_values), torch.from_numpy(attention_mask))
+
+    np.testing.assert_allclose(actual.numpy(), np.stack(expected), atol=1e-5)
+
+
+class CancelledUpload:
+    filename = "vocab.txt"
+
+    def __init__(self):
+        self.reads = 0
+
+    async def read(self, size):
+        self.reads += 1
+        if self.reads > 1:
+            raise asyncio.CancelledError
+        return b"abc"
+
+
+def test_save_upload_removes_partial_file_on_cancel(monkeypatch, tmp_path):
+    monkeypatch.setattr(fast, "TEMP_DIR", str(tmp_path))
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(fast.save_upload(CancelledUpload()))
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def tiny_config(**kwargs):
+    kwargs = {"vocab_size": 8, "hidden_size": 16, "num_hidden_layers": 1,
+              "num_attention_heads": 2, "intermediate_size": 32, "conv_dim": (8,) * 7,
+              "num_conv_pos_embeddings": 16, "feat_extract_norm": "layer",
+              "do_stable_layer_norm": True, **kwargs}
+    return Wav2Vec2Config(**kwargs)
+
+
+@pytest.mark.parametrize("config_kwargs", [
+    {},
+    {"conv_kernel": (7, 3, 3), "conv_stride": (4, 2, 2), "conv_dim": (8,) * 3},
+    {"add_adapter": True, "num_adapter_layers": 2, "adapter_stride": 2},
+])
+def test_frame_lengths_match_model(monkeypatch, config_kwargs):
+    config = tiny_config(**config_kwargs)
+    model = Wav2Vec2ForCTC(config)
+    monkeypatch.setattr(fast.app.state, "config", config, raising=False)
+    sample_lengths = torch.tensor([400, 401, 1000, 16000, 16001, 48000, 480000])
+
+    expected = model._get_feat_extract_output_lengths(sample_lengths)
+
+    assert fast.frame_lengths(sample_lengths).tolist() == expected.tolist()
+
+
+@pytest.fixture
+def tiny_model(monkeypatch, tmp_path):
+    vocab_path = tmp_path / "vocab.json"
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3, "|": 4, "a": 5, "b": 6, "c": 7}
+    vocab_path.write_text(json.dumps(vocab))
+    feature_extractor = Wav2Vec2FeatureExtractor(return_attention_mask=True, do_normalize=False)
+    processor = Wav2Vec2Processor(feature_extractor, Wav2Vec2CTCTokenizer(str(vocab_path)))
+
+    config = tiny_config()
+    torch.manual_seed(0)
+    state = {"processor": processor, "config": config, "device": "cpu",
+             "dtype": torch.float32, "normalize": True,
+             "model": Wav2Vec2ForCTC(config).eval()}
+    for name, value in state.items():
+        monkeypatch.setattr(fast.app.state, name, value, raising=False)
+    monkeypatch.setattr(fast, "INFERENCE_BACKEND", "torch")
+
+
+def test_batched_transcription_matches_single_segments(tiny_model):
+    rng = np.random.default_rng(0)
+    segments = [(rng.standard_normal(length).astype(np.float32), 16000)
+                for length in (16000, 4000, 9600)]
+
+    batched = fast.transcribe_batch(segments)
+    single = [fast.transcribe_batch([segment])[0] for segment in segments]
+
+    assert batched == single
+
+
+def transcribe_stub(batches):
+    def transcribe_batch(segments):
+        batches.append([len(waveform) for waveform, _ in segments])
+        return [f"segment {len(waveform)}" for waveform, _ in segments]
+    return transcribe_batch
+
+
+async def queue_segments(queue, lengths):
+    loop = asyncio.get_running_loop()
+    futures = []
+    for length in lengths:
+        future = loop.create_future()
+        await queue.put((np.zeros(length, dtype=np.float32), 16000, future))
+        futures.append(future)
+    return futures
+
+
+def run_with_worker(scenario, maxsize=2):
+    async def main():
+        queue = asyncio.Queue(maxsize=maxsize)
+        worker = asyncio.create_task(fast.batch_worker(queue))
+        try:
+            return await asyncio.wait_for(scenario(queue), timeout=5)
+        finally:
+            worker.cancel()
+
+    return asyncio.run(main())
+
+
+def test_batch_worker_batches_segments_within_window(monkeypatch):
+    batches = []
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_stub(batches))
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0.05)
+    monkeypatch.setattr(fast, "MAX_BATCH_SIZE", 4)
+
+    async def scenario(queue):
+        results = await asyncio.gather(*await queue_segments(queue, [1, 2]))
+        return results + await asyncio.gather(*await queue_segments(queue, [3]))
+
+    assert run_with_worker(scenario) == ["segment 1", "segment 2", "segment 3"]
+    assert batches == [[1, 2], [3]]
+
+
+def test_batch_worker_caps_batch_size(monkeypatch):
+    batches = []
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_stub(batches))
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0.05)
+    monkeypatch.setattr(fast, "MAX_BATCH_SIZE", 4)
+
+    async def scenario(queue):
+        return await asyncio.gather(*await queue_segments(queue, [1, 2, 3, 4, 5, 6]))
+
+    assert run_with_worker(scenario) == [f"segment {n}" for n in range(1, 7)]
+    assert batches == [[1, 2, 3, 4], [5, 6]]
+
+
+def test_batch_worker_sets_exception_on_every_future(monkeypatch):
+    def transcribe_batch(segments):
+        raise RuntimeError("forward failed")
+
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_batch)
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0.05)
+
+    async def scenario(queue):
+        futures = await queue_segments(queue, [1, 2])
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = run_with_worker(scenario)
+
+    assert len(results) == 2
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_batch_worker_drops_cancelled_segments(monkeypatch):
+    batches = []
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_stub(batches))
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0.05)
+
+    async def scenario(queue):
+        futures = await queue_segments(queue, [1, 2])
+        futures[0].cancel()
+        result = await futures[1]
+        # The worker must still be alive to serve the next batch
+        return [result] + await asyncio.gather(*await queue_segments(queue, [3]))
+
+    assert run_with_worker(scenario) == ["segment 2", "segment 3"]
+    assert batches == [[2], [3]]
+
+
+def test_bounded_queue_interleaves_requests(monkeypatch):
+    batches = []
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_stub(batches))
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0)
+    monkeypatch.setattr(fast, "MAX_BATCH_SIZE", 1)
+
+    async def request(queue, lengths):
+        return await asyncio.gather(*await queue_segments(queue, lengths))
+
+    async def scenario(queue):
+        long_request = asyncio.create_task(request(queue, [10, 11, 12, 13, 14, 15]))
+        await asyncio.sleep(0)
+        await request(queue, [1])
+        await long_request
+
+    run_with_worker(scenario, maxsize=2)
+
+    # The short request does not wait for every segment of the long one
+    assert batches.index([1]) < batches.index([15])
+
+
+def test_lifespan_fails_pending_segments_on_shutdown(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def transcribe_batch(segments):
+        started.set()
+        release.wait(5)
+        return ["late"] * len(segments)
+
+    monkeypatch.setattr(fast, "load_model", lambda state: None)
+    monkeypatch.setattr(fast, "transcribe_batch", transcribe_batch)
+    monkeypatch.setattr(fast, "BATCH_WINDOW", 0)
+    monkeypatch.setattr(fast, "MAX_BATCH_SIZE", 1)
+
+    async def main():
+        async with fast.lifespan(fast.app):
+            futures = await queue_segments(fast.app.state.batch_queue, [1, 2, 3])
+            await asyncio.to_thread(started.wait, 5)
+        release.set()
+        return await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 5)
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        release.set()
+
+    assert len(results) == 3
+    assert all(isinstance(result, RuntimeError) for result in results)
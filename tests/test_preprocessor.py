@@ -0,0 +1,37 @@
+import numpy as np
+
+from audio2corpus.preprocessor import split_audio
+
+
+def test_split_audio_empty_input():
+    assert split_audio(np.zeros(0, dtype=np.float32), 16000) == []
+
+
+def test_split_audio_exact_multiple():
+    waveform = np.arange(2 * 480000, dtype=np.float32)
+
+    segments = split_audio(waveform, 16000)
+
+    assert [len(segment) for segment in segments] == [480000, 480000]
+    np.testing.assert_array_equal(np.concatenate(segments), waveform)
+
+
+def test_split_audio_keeps_tail_of_minimum_length():
+    waveform = np.zeros(480000 + 400, dtype=np.float32)
+
+    assert [len(segment) for segment in split_audio(waveform, 16000)] == [480000, 400]
+
+
+def test_split_audio_drops_short_tail():
+    waveform = np.zeros(4 * 480000 + 160, dtype=np.float32)
+
+    assert [len(segment) for segment in split_audio(waveform, 16000)] == [480000] * 4
+    assert split_audio(np.zeros(399, dtype=np.float32), 16000) == []
+
+
+def test_split_audio_segments_are_views():
+    waveform = np.zeros(480000 + 16000, dtype=np.float32)
+
+    segments = split_audio(waveform, 16000)
+
+    assert all(np.shares_memory(segment, waveform) for segment in segments)